@@ -1,110 +1,270 @@
+import contextlib
+import functools
 import json
-import os
-import subprocess
+import queue
+import threading
+import time
 import tkinter as tk
 import zipfile
-from tkinter import filedialog
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tkinter import filedialog, messagebox
 
+from esptool.cmds import attach_flash, detect_chip, write_flash
+from esptool.logger import log
+from serial import Serial, SerialException
 from serial.tools import list_ports
 
+try:
+    from termios import error as TermiosError
+except ImportError:
+    # termios only exists on POSIX
+    TermiosError = OSError
+
 # Config path for ESP32 devices
 CONFIG_PATH = 'device_config.json'
 
-# Load the config to a constant
-with open(CONFIG_PATH, 'r') as f:
-    CONFIG = json.load(f)
-
-# Baud Rate constant necessary for uploading data to the ESP32
-BAUD_RATE = CONFIG['baud_rate']
+# Baud Rate used to talk to the ESP32 ROM bootloader before switching to the configured baud rate
+ROM_BAUD_RATE = 115200
 
 # Enable or disable console output
 DISABLE_CONSOLE_OUTPUT = True
 
-# ESP32 flash memory chunk size
+# ESP32 flash memory chunk size (must be a power of two)
 CHUNK_SIZE = 0x1000
 
+# ROM bootloader SYNC command and the start of its response, both SLIP framed
+SYNC_FRAME = b'\xc0\x00\x08\x24\x00\x00\x00\x00\x00\x07\x07\x12\x20' + b'\x55' * 32 + b'\xc0'
+SYNC_RESPONSE = b'\xc0\x01\x08'
+SYNC_ATTEMPTS = 5
+
+# Seconds before a port without a device is checked again (the device may be put in download mode later)
+PORT_RECHECK_TIME = 5
+
+# USB vendor IDs of serial bridges found on ESP32 boards
+# (SiLabs CP210x, WCH CH340, FTDI and Espressif native USB)
+ESP_USB_VIDS = {0x10C4, 0x1A86, 0x0403, 0x303A}
+
+# USB product ID of the USB-JTAG-Serial peripheral of ESP32 chips with native USB (S3, C3, C6...)
+USB_JTAG_SERIAL_PID = 0x1001
+
 # Device status constants
 DEVICE_FOUND = 0
 DEVICE_FOUND_OUTPUT = 'ESP device found. Ready to upload.'
 
 BOOT_MODE_ERROR = 1
-BOOT_MODE_ERROR_TEXT = 'Wrong boot mode detected'
 BOOT_MODE_ERROR_OUTPUT = 'ESP device not in proper boot mode. Please put the device in download mode.'
 
 NO_DEVICE_FOUND = 2
-NO_DEVICE_FOUND_TEXT = 'fatal error occurred: Failed to connect'
 NO_DEVICE_FOUND_OUTPUT = 'No ESP device found. Please attach the device through a USB port.'
 
+# Status text shown in the GUI for each device status
+STATUS_OUTPUTS = {
+    DEVICE_FOUND: DEVICE_FOUND_OUTPUT,
+    BOOT_MODE_ERROR: BOOT_MODE_ERROR_OUTPUT,
+    NO_DEVICE_FOUND: NO_DEVICE_FOUND_OUTPUT,
+}
+
+# Upload status text
+UPLOADING_OUTPUT = 'Uploading files... (this may take a while)'
+UPLOAD_SUCCESS_OUTPUT = 'Files uploaded successfully!'
+UPLOAD_FAILED_OUTPUT = 'File upload failed. Please reconnect the device and try again.'
+
 
 current_status = None
 
+# Ports checked without finding a device mapped to when they were checked, and the last ESP32 found
+_last_ports = {}
+_known_esp = None
+
+
+@functools.cache
+def get_config():
+    # Load the config on first use
+    with open(CONFIG_PATH, 'r') as f:
+        return json.load(f)
+
+
+def get_baud_rate():
+    # Baud Rate necessary for uploading data to the ESP32 (the config may store it as a string or a number)
+    return int(get_config()['baud_rate'])
+
+
+def get_zip_layout(zip):
+    # Lay out the files of the zip in flash, returning (address, file info) pairs
+
+    # Set current address
+    current_address = 0x0
+
+    # Skip folders and empty files (which would overlap the next file)
+    file_infos = [file_info for file_info in zip.filelist
+                  if file_info.filename and not file_info.filename.endswith('/') and file_info.file_size]
+
+    # Put programs first, then order by name so the flash layout does not depend on the zip tool
+    file_list = sorted(file_infos, key=lambda file_info: (not file_info.filename.endswith('.bin'), file_info.filename))
+
+    layout = []
+    for file_info in file_list:
+        layout.append((current_address, file_info))
+
+        # Get uncompressed file size from the zip directory and align the new address up to the next chunk
+        size = file_info.file_size
+        current_address = (current_address + size + CHUNK_SIZE - 1) & ~(CHUNK_SIZE - 1)
+
+    return layout
+
+
+def read_zip_segments(zip, layout):
+    # Read contents of files in the order they are stored, so the zip is read front to back in one pass,
+    # returning (address, data) segments
+    return [(address, zip.read(file_info))
+            for address, file_info in sorted(layout, key=lambda item: item[1].header_offset)]
+
 
 def get_used_ports():
-    # Gets all used ports
-    ports = list(list_ports.comports())
-    return [tuple(p) for p in ports]
+    # Gets all used ports that could belong to an ESP32, mapped to their USB product IDs
+    return {p.device: p.pid for p in list_ports.comports() if p.vid in ESP_USB_VIDS}
 
 
 def get_device():
     # Find port of ESP
-    ports = get_used_ports()
-    for port in ports:
+    global _known_esp, _last_ports
 
-        # Create ESP32 device instance
-        device = ESP32(port[0])
-        # Check if device/port is valid
+    # Only re-check the port of the last ESP32 found
+    if _known_esp is not None:
+        device = _known_esp
         status = device.check_status()
         if status == DEVICE_FOUND:
             return device, status
-        # Check if device is in improper boot mode
-        if status == BOOT_MODE_ERROR:
-            return None, status
+        # Device is gone, check the other ports again
+        _known_esp = None
 
-    else:
-        # No valid ports, indicate failure by returning None
-        return None, NO_DEVICE_FOUND
+    # Forget unplugged ports and ports checked too long ago, and only check the remaining ports
+    ports = get_used_ports()
+    now = time.monotonic()
+    _last_ports = {port: checked for port, checked in _last_ports.items()
+                   if port in ports and now - checked < PORT_RECHECK_TIME}
+
+    # Create ESP32 device instances and check every port at the same time
+    devices = [ESP32(port, pid) for port, pid in sorted(ports.items()) if port not in _last_ports]
+    executor = ThreadPoolExecutor(max_workers=8)
+    try:
+        futures = {executor.submit(device.check_status): device for device in devices}
+        for future in as_completed(futures):
+            device = futures[future]
+            status = future.result()
+            if status == DEVICE_FOUND:
+                _known_esp = device
+                return device, status
+            # Check if device is in improper boot mode
+            if status == BOOT_MODE_ERROR:
+                return None, status
+            # Remember when the port had no device
+            _last_ports[device.port] = time.monotonic()
+    finally:
+        # Stop checking the remaining ports
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # No valid ports, indicate failure by returning None
+    return None, NO_DEVICE_FOUND
 
 
 class ESP32:
-    def __init__(self, port):
+    def __init__(self, port, pid=None):
         self.port = port
+        # Native USB devices go through the USB-JTAG-Serial peripheral, which needs its own reset sequence
+        self.usb_jtag = pid == USB_JTAG_SERIAL_PID
+        # Persistent esptool stub session, opened on the first flash operation
+        self.esp = None
+
+    @staticmethod
+    def _set_rts(port, state):
+        # Set RTS, setting DTR again as the Windows usbser.sys driver only applies RTS changes that way
+        port.rts = state
+        port.dtr = port.dtr
+
+    def _enter_download_mode(self, port):
+        # Reset the ESP32 (EN through RTS) while holding IO0 low (through DTR) to enter download mode
+        if self.usb_jtag:
+            # USB-JTAG-Serial sequence, going through (1, 1) instead of (0, 0) while resetting
+            self._set_rts(port, False)
+            port.dtr = False
+            time.sleep(0.1)
+            port.dtr = True
+            self._set_rts(port, False)
+            time.sleep(0.1)
+            self._set_rts(port, True)
+            port.dtr = False
+            self._set_rts(port, True)
+            time.sleep(0.1)
+            port.dtr = False
+            self._set_rts(port, False)
+        else:
+            port.dtr = False
+            self._set_rts(port, True)
+            time.sleep(0.1)
+            port.dtr = True
+            self._set_rts(port, False)
+            time.sleep(0.05)
+            port.dtr = False
+
+    def _hard_reset(self, port):
+        # Pulse EN (RTS) with IO0 released (DTR) so the device runs its firmware again
+        port.dtr = False
+        self._set_rts(port, True)
+        if self.usb_jtag:
+            # Give the USB-JTAG-Serial peripheral time to handle the reset
+            time.sleep(0.2)
+            self._set_rts(port, False)
+            time.sleep(0.2)
+        else:
+            time.sleep(0.1)
+            self._set_rts(port, False)
 
     def check_status(self):
-        # Run esptool status check
-        result = subprocess.run(['esptool', '--port', self.port, '--baud', BAUD_RATE, 'flash_id'], capture_output=True)
-        # Get result text from stdout
-        text = result.stdout.decode()
-        if not DISABLE_CONSOLE_OUTPUT:
-            print(text)
-        # Check for boot mode error
-        if BOOT_MODE_ERROR_TEXT in text:
-            return BOOT_MODE_ERROR
-        # Check for any other error
-        if NO_DEVICE_FOUND_TEXT in text:
+        # Reset the ESP32 into its ROM bootloader and check that it answers a SYNC command
+        try:
+            with Serial(self.port, ROM_BAUD_RATE, timeout=0.1) as port:
+                self._enter_download_mode(port)
+                port.reset_input_buffer()
+
+                response = b''
+                for _ in range(SYNC_ATTEMPTS):
+                    port.write(SYNC_FRAME)
+                    response += port.read(16)
+                    if SYNC_RESPONSE in response:
+                        self._hard_reset(port)
+
+                        # Status is good
+                        return DEVICE_FOUND
+        except (SerialException, OSError, TermiosError):
+            # Port can't be used (pyserial raises raw OS errors if unplugged while checking), no device on this port
             return NO_DEVICE_FOUND
-        # Status is good
-        return DEVICE_FOUND
-
-    def upload_file(self, address, file_path):
-        # Upload the given file path
-        result = subprocess.run(['esptool', '--port', self.port, '--baud', str(BAUD_RATE), 'write_flash',
-                                 '--flash_size=detect', hex(address), f'{file_path}'], check=True, capture_output=True)
-        if not DISABLE_CONSOLE_OUTPUT:
-            print(result.stdout.decode())
-
-    def upload_program(self, address, file_path):
-        # Upload the given file path
-        result = subprocess.run(['esptool', '--port', self.port, '--baud', str(BAUD_RATE), 'write_flash',
-                                 '--flash_size=detect', hex(address), f'{file_path}'], check=True, capture_output=True)
-        if not DISABLE_CONSOLE_OUTPUT:
-            print(result.stdout.decode())
-
-    def clear_flash(self):
-        # Clear the flash memory
-        result = subprocess.run(['esptool', '--port', self.port, '--baud', str(BAUD_RATE), 'erase_flash'], check=True,
-                                capture_output=True)
-        if not DISABLE_CONSOLE_OUTPUT:
-            print(result.stdout.decode())
+        # Port works but the ROM bootloader did not answer, device is in the wrong boot mode
+        return BOOT_MODE_ERROR
+
+    def connect(self):
+        # Connect and load the flasher stub once, reusing the session for every flash operation
+        if self.esp is None:
+            esp = detect_chip(self.port, baud=ROM_BAUD_RATE)
+            esp = esp.run_stub()
+            esp.change_baud(get_baud_rate())
+            attach_flash(esp)
+            self.esp = esp
+        return self.esp
+
+    def close(self):
+        # Reset the device, leaving the esptool session releases the serial port
+        if self.esp is None:
+            return
+        with self.esp:
+            self.esp.hard_reset()
+        self.esp = None
+
+    def upload_all(self, segments, erase_all=False):
+        # Upload every (address, bytes) segment in a single flash write, optionally erasing the whole flash first
+        # (esptool's write_flash needs named files for file objects, so the data must be bytes)
+        esp = self.connect()
+        write_flash(esp, segments, flash_size='detect', erase_all=erase_all)
 
 
 class GUI(tk.Tk):
@@ -120,13 +280,28 @@ class GUI(tk.Tk):
         # Size the GUI
         self.geometry('600x500')
 
+        # Load the config, showing an error instead of crashing if it can't be read
+        try:
+            config = get_config()
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            messagebox.showerror('ESP32 Uploader', f'Could not load the config file {CONFIG_PATH}: {e}')
+            config = None
+
         # Create a title label
         self.title = tk.Label(self, text='Welcome to ESP32 Uploading Tool!', font=("Arial", 24))
         self.title.pack(padx=5, pady=30)
 
         # Create a button to upload the ZIP file
         self.button = tk.Button(self, text='Upload ZIP File', command=self.upload_zip_folder, font=("Arial", 16), bg='lightgray')
-        self.button.pack(padx=5, pady=30)
+        self.button.pack(padx=5, pady=(30, 5))
+        if config is None:
+            # Uploading needs the baud rate from the config
+            self.button.config(state=tk.DISABLED)
+
+        # Create a checkbox to erase the whole flash memory instead of only the written sectors
+        self.full_erase = tk.BooleanVar(value=False)
+        self.full_erase_button = tk.Checkbutton(self, text='Full erase', variable=self.full_erase, font=("Arial", 12))
+        self.full_erase_button.pack(padx=5, pady=5)
 
         # Create a label to with status
         self.status = tk.Label(self, text=f'Checking for an ESP device...', font=("Arial", 12),
@@ -134,44 +309,59 @@ class GUI(tk.Tk):
         self.status.pack(padx=5, pady=30)
 
         # Create a label with instructions
-        self.instructions = tk.Label(self, text=f'Instructions: {CONFIG["instructions"]}', font=("Arial", 12), wraplength=400, justify=tk.LEFT)
+        self.instructions = tk.Label(self, text=f'Instructions: {config["instructions"] if config else ""}', font=("Arial", 12), wraplength=400, justify=tk.LEFT)
         self.instructions.pack(padx=5, pady=30)
 
+        # Queue of status text posted by worker threads, shown by the GUI thread
+        self._status_q = queue.Queue()
+
+        # Check for an ESP32 device on a worker thread so the GUI never blocks
+        self._start_probe()
+
     def run(self):
         # Run the GUI
 
-        # Create ESP32 check task
-        def task():
-            global current_status
+        # Show status updates from the worker threads
+        self.after(100, self._drain_queue)
+
+        # Run the tkinter mainloop
+        self.mainloop()
 
-            # Try to find an ESP32 device
-            _, current_status = get_device()
+    def _start_probe(self):
+        # Start the ESP32 check task on a worker thread
+        threading.Thread(target=self._probe_loop, daemon=True).start()
 
-            # Output status text for device found
+    def _probe_loop(self):
+        # Check for an ESP32 device every second until one is found
+        global current_status
+        while True:
+            time.sleep(1)
+
+            # Try to find an ESP32 device, treating any error as no device so checking carries on
+            try:
+                _, current_status = get_device()
+            except Exception as e:
+                print(f'Device check failed: {e}')
+                current_status = NO_DEVICE_FOUND
+            self._status_q.put(STATUS_OUTPUTS[current_status])
+
+            # Stop checking once a device is found
             if current_status == DEVICE_FOUND:
-                self.status.config(text=DEVICE_FOUND_OUTPUT)
-                # Reschedule task after 10 seconds
                 return
 
-            # Output status text for boot mode error
-            if current_status == BOOT_MODE_ERROR:
-                self.status.config(text=BOOT_MODE_ERROR_OUTPUT)
+    def _drain_queue(self):
+        # Output the status text posted by the worker threads
+        try:
+            while True:
+                self.status.config(text=self._status_q.get_nowait())
+        except queue.Empty:
+            pass
 
-            # Output status text for no device found
-            if current_status == NO_DEVICE_FOUND:
-                self.status.config(text=NO_DEVICE_FOUND_OUTPUT)
-
-            # Reschedule task after 1 second
-            self.after(1000, task)
-
-        # Schedule task after 1 second
-        self.after(1000, task)
-
-        # Run the tkinter mainloop
-        self.mainloop()
+        # Reschedule after 100 milliseconds
+        self.after(100, self._drain_queue)
 
     def upload_zip_folder(self):
-        # Selects a file from GUI and uploads it to ESP32
+        # Selects a file from GUI and uploads it to ESP32 on a worker thread
 
         # Make sure device status is good before asking for file
         global current_status
@@ -181,69 +371,65 @@ class GUI(tk.Tk):
 
         # Open a file dialog and get the selected folder
         file_path = filedialog.askopenfilename(title="Select a ZIP File", filetypes=(('zip files', '*.zip'),))
-
-        self.status.config(text='Uploading files... (this may take a while)')
-        self.update()
-
-        device, _ = get_device()
-        if device is None:
-            # If no device indicate failure by returning False
-            self.after(1000, task)
+        if not file_path:
+            # If no file was selected indicate failure by returning False
             return False
 
-        # Clear flash memory in the ESP32
-        device.clear_flash()
-
-        # Read in zip file
-        with zipfile.ZipFile(file_path) as zip:
+        # Block further uploads until this one is finished
+        current_status = None
+        self.status.config(text=UPLOADING_OUTPUT)
 
-            # Set current address
-            current_address = 0x0
+        threading.Thread(target=self._upload_worker, args=(file_path, self.full_erase.get()), daemon=True).start()
 
-            file_list = [file_name for file_name in zip.filelist if file_name.filename.endswith('.bin')]
-            file_list.extend(file_name for file_name in zip.filelist if not file_name.filename.endswith('.bin'))
+        # Indicate the upload was started by returning True
+        return True
 
-            # Iterate through files in zip
-            print(f'Uploading ZIP file contents... ({len(file_list)} files)')
-            for i, file_name in enumerate(file_list, 1):
-                # Skip unwanted files
-                if file_name.filename in [None, '/']:
-                    continue
+    def _upload_worker(self, file_path, full_erase):
+        # Uploads the given ZIP file to ESP32
+        global current_status
 
-                # Read contents of file
-                f = zip.open(file_name, mode='r')
+        try:
+            device, status = get_device()
+            if device is None:
+                # If no device go back to checking for one
+                self._status_q.put(STATUS_OUTPUTS[status])
+                self._start_probe()
+                return
 
-                # Open temp file
-                file_name = file_name.filename
-                print(f'  ({i}) - {file_name}')
-                temp_path = f'temp{file_name[file_name.rindex("."):]}'
-                with open(temp_path, 'wb') as temp:
-                    temp.write(bytes(f.read()))
+            # Read in zip file, closing the device session once done
+            with contextlib.closing(device), zipfile.ZipFile(file_path) as zip, \
+                    ThreadPoolExecutor(max_workers=1) as executor:
 
-                # Close file
-                f.close()
+                # Lay out the files in flash
+                layout = get_zip_layout(zip)
+                print(f'Uploading ZIP file contents... ({len(layout)} files)')
+                for i, (_, file_info) in enumerate(layout, 1):
+                    print(f'  ({i}) - {file_info.filename}')
 
-                # Upload the file to the ESP32
-                if file_name.endswith('.bin'):
-                    device.upload_program(current_address, temp_path)
-                else:
-                    device.upload_file(current_address, temp_path)
+                # Read the files on a separate thread while connecting to the ESP32
+                reading = executor.submit(read_zip_segments, zip, layout)
+                device.connect()
 
-                # Get file size and calculate new address
-                size = os.path.getsize(temp_path)
-                current_address = ((current_address + size) // CHUNK_SIZE + 1) * CHUNK_SIZE
+                # Upload all files to the ESP32 at once, write_flash only erases the sectors it writes to
+                device.upload_all(reading.result(), erase_all=full_erase)
 
-                # Remove temp file
-                os.remove(temp_path)
+        except Exception as e:
+            # If the upload fails for any reason go back to checking for a device, so it can be retried
+            print(f'File uploading failed: {e}')
+            self._status_q.put(UPLOAD_FAILED_OUTPUT)
+            self._start_probe()
+            return
 
         print('File uploading complete!')
-        self.status.config(text='Files uploaded successfully!')
-
-        # Indicate success by returning True
-        return True
+        self._status_q.put(UPLOAD_SUCCESS_OUTPUT)
+        current_status = DEVICE_FOUND
 
 
 def main():
+    # Silence esptool through its own logger, swapping sys.stdout is not safe with several worker threads
+    if DISABLE_CONSOLE_OUTPUT:
+        log.set_verbosity('silent')
+
     gui = GUI()
     gui.run()
 